@@ -1,4 +1,9 @@
-from .ckpt_fixed_o1 import checkpoint
+from .ckpt_fixed_o1 import (
+    DEFAULT_FLAGS,
+    MINIMAL_FLAGS,
+    checkpoint,
+    restore_from_template,
+)
 # from .ckpt_forked import checkpoint
 # from .ckpt_early import checkpoint
 # from .ckpt_execvp import checkpoint
@@ -1,50 +1,410 @@
+"""
+Checkpoint a Python process with CRIU once the imports in a `checkpoint()` block ran.
+
+The block only ever runs in a forked child: the parent stays as lean as it was before
+the imports, and runs `criu dump` with `posix_spawn` so it never copies a large heap.
+Do not enter `checkpoint()` again from inside the block (i.e. from the forked child).
+"""
+
+import collections
 import fcntl
+import functools
 import hashlib
-import json
+import logging
 import os
+import shutil
 import signal
-import subprocess
+import struct
 import sys
+import threading
 import time
+from collections.abc import Sequence
 from contextlib import contextmanager
 from pathlib import Path
 
-from platformdirs import user_cache_dir
-
 __all__ = (
+    "DEFAULT_FLAGS",
+    "MINIMAL_FLAGS",
+    "_criu_cmd",
+    "_ensure_base_dir",
+    "_get_checkpoint_dirs",
     "_get_checkpoint_path",
+    "_last_cpu",
+    "_log_criu_output",
+    "_mark_checkpoint_complete",
+    "_move_to_trash",
+    "_remove_dirs",
+    "_remove_in_background",
+    "_set_lock",
+    "_spawn_criu",
+    "_spawn_criu_piped",
+    "_start_lazy_pages",
+    "_unshare_cmd",
+    "_wait_for_removals",
+    "_canonical_context",
     "_generate_checkpoint_id",
+    "_hash_checkpoint_id",
     "checkpoint",
     "clear_checkpoints",
+    "restore_from_template",
+)
+
+
+# Only environment vars that affect Python imports go into the checkpoint ID (sorted)
+IMPORT_ENV_VARS = (
+    "PYTHONHOME",
+    "PYTHONNOUSERSITE",
+    "PYTHONPATH",
+    "PYTHONSAFEPATH",
+    "PYTHONUSERBASE",
+)
+
+# The part of the checkpoint ID fixed for the process lifetime: the Python build, and
+# the env vars (only read at startup to set up imports, so later changes are moot)
+_BASE_ID_KEY = repr(
+    (
+        sys.version,
+        tuple((k, v) for k in IMPORT_ENV_VARS if (v := os.environ.get(k)) is not None),
+    )
+).encode()
+
+log = logging.getLogger(__name__)
+criu_log = logging.getLogger("crio.criu")
+
+# Where criu writes the checkpoint images (in `criu-<ID>` dirs)
+TMP_DIR = Path("/tmp")
+
+# Extra criu options for dump and restore (see `checkpoint()`)
+DEFAULT_FLAGS = (
+    "--shell-job",
+    "--skip-in-flight",
+    "--ext-unix-sk",
+    "--file-locks",
+    "--link-remap",
+    "--manage-cgroups",
 )
+MINIMAL_FLAGS = ("--shell-job",)
 
+# True in the forked child while it runs the block, to refuse nested checkpoints
+_in_checkpoint_block = False
+
+# Background deletions started by `clear_checkpoints()`, joined before `checkpoint()`
+# forks or execs (which would cut them short: the process running on has no threads)
+_removal_threads: list[threading.Thread] = []
+
+CAP_SYS_ADMIN = 21
+CAP_CHECKPOINT_RESTORE = 40  # Linux 5.9+
+VFS_CAP_FLAGS_EFFECTIVE = 0x000001
+
+
+def _file_caps(path: str) -> int:
+    """
+    Capability bitmask an executable gains on exec (0 if none): its permitted set, only
+    if the effective bit is set too (as by `+ep`), as criu doesn't raise its own caps.
+    """
+    try:
+        raw = os.getxattr(path, "security.capability")
+    except OSError:
+        return 0
+    # struct vfs_cap_data: u32 magic, then (permitted, inheritable) u32 pairs
+    magic_etc = struct.unpack_from("<I", raw, 0)[0]
+    if not magic_etc & VFS_CAP_FLAGS_EFFECTIVE:
+        return 0
+    permitted_lo = struct.unpack_from("<I", raw, 4)[0]
+    permitted_hi = struct.unpack_from("<I", raw, 12)[0] if len(raw) >= 20 else 0
+    return permitted_hi << 32 | permitted_lo
+
+
+@functools.lru_cache(maxsize=1)
+def _criu_cmd() -> tuple[str, ...]:
+    """
+    Command prefix for criu, only going via `sudo` when it lacks privileges. Paths are
+    resolved once here so no later exec has to search `PATH`.
+    """
+    criu = shutil.which("criu") or "/usr/sbin/criu"
+    ckpt_caps = 1 << CAP_CHECKPOINT_RESTORE | 1 << CAP_SYS_ADMIN
+    if os.geteuid() == 0 or _file_caps(criu) & ckpt_caps:
+        return (criu,)
+    # Non-interactive: fail fast rather than stall on a password prompt
+    return (shutil.which("sudo") or "/usr/bin/sudo", "-n", criu)
+
+
+@functools.lru_cache(maxsize=1)
+def _unshare_cmd() -> tuple[str, ...]:
+    """
+    Command prefix to run criu as init of a new PID namespace with its own `/proc`,
+    always via `sudo` unless root (a file capability on criu is no use to `unshare`).
+    """
+    unshare = shutil.which("unshare") or "/usr/bin/unshare"
+    ns_cmd = (unshare, "--pid", "--fork", "--mount-proc", "--")
+    if os.geteuid() == 0:
+        return ns_cmd
+    return (shutil.which("sudo") or "/usr/bin/sudo", "-n", *ns_cmd)
+
+
+def _last_cpu(pid: int) -> int | None:
+    """The CPU a process last ran on (field 39 of its `/proc/<pid>/stat`)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Split after the parenthesised command name, which may itself contain spaces
+    return int(stat[stat.rindex(")") + 2 :].split()[36])
+
+
+def _spawn_criu_piped(args: list[str]) -> tuple[int, int]:
+    """
+    Start criu with its stdout and stderr sent to a pipe, returning its PID and the read
+    end of the pipe (which hits EOF once criu exits).
+    """
+    argv = [*_criu_cmd(), *args]
+    read_fd, write_fd = os.pipe()
+    try:
+        criu_pid = os.posix_spawn(
+            argv[0],
+            argv,
+            os.environ,
+            file_actions=[
+                (os.POSIX_SPAWN_DUP2, write_fd, 1),
+                (os.POSIX_SPAWN_DUP2, write_fd, 2),
+            ],
+        )
+    except OSError:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    return criu_pid, read_fd
 
+
+def _log_criu_output(
+    read_fd: int, pending: bytearray, last_lines: collections.deque
+) -> None:
+    """Log the lines criu wrote to a non-blocking pipe so far, keeping a partial line"""
+    try:
+        while chunk := os.read(read_fd, 65536):
+            pending += chunk
+    except BlockingIOError:
+        pass
+    *lines, pending[:] = pending.split(b"\n")
+    for raw_line in lines:
+        line = raw_line.decode(errors="replace").rstrip()
+        criu_log.debug(line)
+        last_lines.append(line)
+
+
+def _spawn_criu(args: list[str], cpu: int | None = None) -> None:
+    """
+    Run criu with `posix_spawn` (vfork + exec on glibc) rather than `fork`, so the
+    page tables of this process are never duplicated. Its output is streamed line by
+    line to the `crio.criu` logger while it runs, kept apart from the program's own.
+
+    If a `cpu` is given, criu is pinned to it (e.g. where the target process last ran,
+    so the caches are warm with its memory and criu never migrates between cores).
+    """
+    old_affinity = os.sched_getaffinity(0)
+    pin = cpu is not None and cpu in old_affinity
+    if pin:
+        os.sched_setaffinity(0, {cpu})  # Inherited by the spawned criu
+    try:
+        criu_pid, read_fd = _spawn_criu_piped(args)
+    finally:
+        if pin:
+            os.sched_setaffinity(0, old_affinity)
+    last_lines = collections.deque(maxlen=20)
+    with open(read_fd, "rb") as output:
+        for raw_line in output:
+            line = raw_line.decode(errors="replace").rstrip()
+            criu_log.debug(line)
+            last_lines.append(line)
+    _, status = os.waitpid(criu_pid, 0)
+    if (returncode := os.waitstatus_to_exitcode(status)) != 0:
+        output_tail = "\n".join(last_lines)
+        raise RuntimeError(f"criu {args[0]} failed ({returncode}):\n{output_tail}")
+
+
+def _start_lazy_pages(checkpoint_dir: Path, timeout: float = 1.0) -> None:
+    """
+    Start the `criu lazy-pages` daemon to serve the page images of a restore run with
+    `--lazy-pages`, once the kernel was asked to read those images ahead (async).
+    """
+    for entry in os.scandir(checkpoint_dir):
+        if entry.name.startswith("pages-"):
+            try:
+                fd = os.open(entry.path, os.O_RDONLY)
+            except PermissionError:
+                continue  # Written by root via sudo: leave it to criu to read
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+    args = ["lazy-pages", "-D", str(checkpoint_dir), "--unprivileged"]
+    daemon_pid, read_fd = _spawn_criu_piped(args)
+    os.set_blocking(read_fd, False)
+    pending, last_lines = bytearray(), collections.deque(maxlen=20)
+    # The restore has to find the daemon listening on its socket in the images dir
+    socket_path = checkpoint_dir / "lazy-pages.socket"
+    deadline = time.monotonic() + timeout
+    try:
+        while not socket_path.exists():
+            _log_criu_output(read_fd, pending, last_lines)
+            wpid, status = os.waitpid(daemon_pid, os.WNOHANG)
+            if wpid:  # Exited (e.g. `sudo -n` was refused) without ever listening
+                _log_criu_output(read_fd, pending, last_lines)
+                returncode = os.waitstatus_to_exitcode(status)
+                output_tail = "\n".join(last_lines)
+                raise RuntimeError(
+                    f"criu lazy-pages failed ({returncode}):\n{output_tail}"
+                )
+            if time.monotonic() > deadline:
+                os.kill(daemon_pid, signal.SIGTERM)  # Relayed to criu by sudo
+                os.waitpid(daemon_pid, 0)
+                raise RuntimeError("criu lazy-pages daemon did not start")
+            time.sleep(0.005)
+    except BaseException:
+        os.close(read_fd)
+        raise
+    _log_criu_output(read_fd, pending, last_lines)
+    # Nothing reads the pipe once this process execs into `criu restore`, but keep it
+    # open across the exec so the daemon isn't killed by SIGPIPE when it logs
+    os.set_inheritable(read_fd, True)
+
+
+def _mark_checkpoint_complete(checkpoint_dir: Path) -> None:
+    """
+    Write the `checkpoint.exists` sentinel atomically (fsync then rename), so a crash
+    can never leave a sentinel beside a partial dump.
+    """
+    tmp_sentinel = checkpoint_dir / ".ckpt.tmp"
+    fd = os.open(tmp_sentinel, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, b"ok\n")
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_sentinel, checkpoint_dir / "checkpoint.exists")
+
+
+def _set_lock(fd: int, lock_type: int) -> None:
+    """
+    Set (`F_WRLCK`, non-blocking) or release (`F_UNLCK`) a whole-file OFD lock. Unlike
+    `flock` these are record locks, so are honoured on NFS-mounted cache dirs too.
+    """
+    # struct flock: l_type, l_whence, l_start, l_len (0 = to EOF), l_pid (0 for OFD)
+    flock = struct.pack("hhqqi", lock_type, os.SEEK_SET, 0, 0, 0)
+    fcntl.fcntl(fd, fcntl.F_OFD_SETLK, flock)
+
+
+@functools.lru_cache(maxsize=1)
 def _get_checkpoint_path() -> Path:
-    """Get the directory for storing checkpoints"""
-    base_dir = Path(user_cache_dir("crio"))
+    """Get the directory for storing checkpoints (created by `_ensure_base_dir`)"""
+    # Deferred so `import crio` doesn't pay for platformdirs' import
+    from platformdirs import user_cache_dir
+
+    return Path(user_cache_dir("crio"))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_checkpoint_dirs(ckpt_id: str) -> tuple[Path, Path]:
+    """
+    The user-level checkpoint directory (holding the lock and the `ckpt` symlink) and
+    the temporary directory in /tmp that criu writes the images to, for a checkpoint ID.
+    """
+    return _get_checkpoint_path() / ckpt_id, TMP_DIR / f"criu-{ckpt_id}"
+
+
+def _ensure_base_dir() -> Path:
+    """Create the checkpoint directory, only needed on paths that write to it"""
+    base_dir = _get_checkpoint_path()
     base_dir.mkdir(parents=True, exist_ok=True)
     return base_dir
 
 
-def _generate_checkpoint_id(context: dict | None = None) -> str:
-    """Generate unique identifier for checkpoint based on Python environment"""
-    checkpoint_context = {
-        "python_version": sys.version,
-        # Only include environment vars that affect Python imports
-        "env": {
-            k: v
-            for k, v in os.environ.items()
-            if k.startswith(("PYTHONPATH", "PYTHONHOME"))
-        },
-    }
-    if context is not None:
-        checkpoint_context.update(context)
-    context_str = json.dumps(checkpoint_context, sort_keys=True)
-    return hashlib.sha256(context_str.encode()).hexdigest()[:16]
+def _generate_checkpoint_id(context: dict | None = None, strict: bool = True) -> str:
+    """
+    Generate unique identifier for checkpoint based on Python environment. If not
+    `strict`, a (non-empty) `context` is trusted to pin the environment by itself, so
+    neither the Python build nor the env vars are included.
+    """
+    base_key = _BASE_ID_KEY if strict or not context else b""
+    # C-level repr, unambiguous, no JSON (and unlike the items themselves, which are
+    # equal for 1, 1.0 and True, these bytes tell such values apart)
+    context_key = repr(_canonical_context(context or {})).encode()
+    return _hash_checkpoint_id(base_key, context_key)
+
+
+def _canonical_context(value):
+    """
+    A copy of a context value whose repr is the same in every run: dicts (at any depth)
+    are rebuilt in key order. Values of other types than JSON would accept (but keeping
+    tuples and bytes) are rejected, as their repr may hold an address (`<... at 0x>`).
+    """
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return value
+    if isinstance(value, dict):
+        items = [tuple(map(_canonical_context, item)) for item in value.items()]
+        return dict(sorted(items, key=lambda item: repr(item[0])))
+    if isinstance(value, (list, tuple)):
+        values = map(_canonical_context, value)
+        return list(values) if isinstance(value, list) else tuple(values)
+    raise TypeError(
+        f"Checkpoint context value of type {type(value).__name__} has no stable repr"
+    )
+
+
+def _hash_checkpoint_id(base_key: bytes, context_key: bytes) -> str:
+    """Hash the ID inputs, 8 bytes = 16 hex chars"""
+    h = hashlib.blake2b(base_key, digest_size=8)
+    h.update(context_key)
+    return h.hexdigest()
+
+
+def _move_to_trash(path: Path) -> Path:
+    """Rename a directory out of the way (as a hidden sibling) ready to be deleted"""
+    return path.rename(path.with_name(f".{path.name}.trash-{os.urandom(4).hex()}"))
+
+
+def _remove_in_background(paths: list[Path]) -> None:
+    """Delete directory trees on a thread, to be joined by `_wait_for_removals()`"""
+    thread = threading.Thread(target=_remove_dirs, args=(paths,))
+    thread.start()
+    _removal_threads.append(thread)
+
+
+def _wait_for_removals() -> None:
+    """Let any background deletions finish, before the process forks or execs"""
+    while _removal_threads:
+        _removal_threads.pop().join()
+
+
+def _remove_dirs(paths: list[Path]) -> None:
+    """
+    Delete directory trees, logging what couldn't be deleted (e.g. images written by
+    root via sudo) rather than raising, as this mostly runs on a background thread.
+    What is left over stays as trash for the next `clear_checkpoints()` to retry.
+    """
+
+    def log_failure(func, path, exc):
+        if not isinstance(exc, BaseException):  # `onerror` passes the exc_info triple
+            exc = exc[1]
+        log.warning("Failed to delete checkpoint file %s: %s", path, exc)
+
+    for path in paths:
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(path, onexc=log_failure)
+        else:
+            shutil.rmtree(path, onerror=log_failure)
 
 
 @contextmanager
-def checkpoint(context: dict | None = None):
+def checkpoint(
+    context: dict | None = None,
+    criu_flags: Sequence[str] = DEFAULT_FLAGS,
+    lazy_pages: bool = False,
+    strict: bool = True,
+    no_hw_breakpoints: bool = True,
+):
     """
     After `fork()`, you now have **two** processes:
 
@@ -73,9 +433,8 @@ def checkpoint(context: dict | None = None):
     checkpointing is done). The code in `finally:` calls
 
     ```python
-    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    _set_lock(lock_fd, fcntl.F_UNLCK)
     os.close(lock_fd)
-    lock_file.unlink()
     ```
 
     which blows up if the child has already closed the descriptor. Meanwhile, the
@@ -86,7 +445,7 @@ def checkpoint(context: dict | None = None):
 
     - The parent takes the lock (and thus owns the valid `lock_fd`).
     - The child quickly closes its *inherited* copy of that FD.
-    - At the end, the *parent* manually unlocks and removes the file.
+    - At the end, the *parent* manually unlocks and closes the file.
     - The child does *not* run that unlock code, because it never truly held the lock.
 
     But since the parent calls `os._exit(0)`, it never returns to the normal Python
@@ -98,89 +457,111 @@ def checkpoint(context: dict | None = None):
     2. If I am the child, skip the lock-unlock portion in the `finally:` block (since
        the child has no valid FD).
     3. If I am the parent, perform the lock clean-up before calling `os._exit(0)`.
+
+    -------------------- criu options -------------------------------------------------
+
+    `criu_flags` are passed to both `criu dump` and `criu restore` (so must not change
+    between the run that dumps and the runs that restore). Each of the `DEFAULT_FLAGS`
+    makes criu collect (and restore) another kind of kernel state. A script that holds
+    no sockets, file locks or cgroups of its own can pass `MINIMAL_FLAGS` for a faster
+    dump, and one holding open TCP connections can add `"--tcp-established"`.
+
+    With `lazy_pages` a restore returns before the process memory is all copied back:
+    a `criu lazy-pages` daemon fills in each page on first touch (via `userfaultfd`,
+    which must be permitted for the user), while the kernel reads the page images
+    ahead into the page cache.
+
+    With `no_hw_breakpoints` (the default) a restore sets `CRIU_FAULT=130`, so criu
+    stops the restored threads at the end of restore by tracing syscalls rather than
+    by setting a hardware breakpoint on each. This has no effect when criu runs via
+    `sudo`, which drops the variable from the environment.
+
+    Pass `strict=False` with a `context` that already pins the environment (e.g. the
+    dependency versions) to identify the checkpoint by that alone, so a rebuilt Python
+    or changed `PYTHONPATH` doesn't invalidate it.
     """
-    # Base user-level checkpoint directory
-    base_checkpoint_dir = _get_checkpoint_path() / _generate_checkpoint_id(context)
-    # Temporary checkpoint directory in /tmp
-    tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+    global _in_checkpoint_block
+    if _in_checkpoint_block:
+        raise RuntimeError("checkpoint() cannot be entered inside a checkpoint() block")
+    _wait_for_removals()
+    ckpt_id = _generate_checkpoint_id(context, strict=strict)
+    base_checkpoint_dir, tmp_checkpoint_dir = _get_checkpoint_dirs(ckpt_id)
     lock_file = base_checkpoint_dir / "crio.lock"
     lock_fd = None
     child_pid = None
     am_child = False
 
     try:
-        # Validate and create directories
+        # Check for existing checkpoint first: restoring needs no dirs, symlink or lock
+        has_checkpoint = (tmp_checkpoint_dir / "checkpoint.exists").exists()
+        if has_checkpoint and not (tmp_checkpoint_dir / "inventory.img").exists():
+            # Images gone (e.g. partly deleted): set it aside and dump afresh instead,
+            # as after the exec below nothing here could react to criu failing
+            print("Checkpoint images missing, discarding checkpoint")
+            _remove_dirs([_move_to_trash(tmp_checkpoint_dir)])
+            has_checkpoint = False
+        if has_checkpoint:
+            print("Found existing checkpoint, attempting restore...")
+            # Become criu, which restores the checkpointed process (left stopped just
+            # after the block) in place of this one: exec never returns on success.
+            argv = [
+                *_criu_cmd(),
+                "restore",
+                "-D",
+                str(tmp_checkpoint_dir),
+                "--unprivileged",
+                *criu_flags,
+            ]
+            if lazy_pages:
+                _start_lazy_pages(tmp_checkpoint_dir)
+                argv.append("--lazy-pages")
+            env = os.environ
+            if no_hw_breakpoints:
+                env = {**env, "CRIU_FAULT": "130"}
+            sys.stdout.flush()  # Buffered output would be lost on exec
+            try:
+                os.execve(argv[0], argv, env)
+            except OSError as e:
+                print(f"Checkpoint restore failed: {e}")
+                raise RuntimeError("Checkpoint restore failed")
+
+        # No existing checkpoint: validate and create directories to dump into
         for dir_path, err_msg in [
             (base_checkpoint_dir, "checkpoint directory"),
             (tmp_checkpoint_dir, "temporary checkpoint directory"),
         ]:
+            # Private (the images hold process memory), and no parents/exist_ok stats
             try:
-                dir_path.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.mkdir(dir_path, 0o700)
+                except FileNotFoundError:
+                    _ensure_base_dir()  # First ever checkpoint, no cache dir yet
+                    os.mkdir(dir_path, 0o700)
+            except FileExistsError:
+                pass
             except PermissionError:
                 raise RuntimeError(f"Cannot create {err_msg} - permission denied")
 
-        # Create symlink from base to tmp if it doesn't exist
+        # Create symlink from base to tmp if it doesn't exist (EAFP: no race, no lstat)
         symlink_path = base_checkpoint_dir / "ckpt"
-        if not symlink_path.exists():
-            symlink_path.symlink_to(tmp_checkpoint_dir)
+        try:
+            os.symlink(tmp_checkpoint_dir, symlink_path)
+        except FileExistsError:
+            pass
 
         # Acquire lock file in the parent (before fork)
         try:
             lock_fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
-            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except (PermissionError, IOError) as e:
-            if lock_fd is not None:
-                os.close(lock_fd)
-            if isinstance(e, PermissionError):
-                raise RuntimeError("Cannot create lock file - permission denied")
-            else:
-                raise RuntimeError("Another crio process is running")
-
-        # Check for existing checkpoint
-        if (tmp_checkpoint_dir / "checkpoint.exists").exists():
-            print("Found existing checkpoint, attempting restore...")
-            try:
-                # Use subprocess to restore
-                restore_process = subprocess.Popen(
-                    [
-                        "sudo",
-                        "criu",
-                        "restore",
-                        "-D",
-                        str(tmp_checkpoint_dir),
-                        "--unprivileged",
-                        "--shell-job",
-                        "--skip-in-flight",
-                        "--ext-unix-sk",
-                        "--file-locks",
-                        "--link-remap",
-                        "--manage-cgroups",
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                )
-
-                # Wait for restore to complete
-                stdout, stderr = restore_process.communicate()
-
-                if restore_process.returncode != 0:
-                    print(f"Restore failed. Stdout: {stdout}")
-                    print(f"Restore failed. Stderr: {stderr}")
-                    raise subprocess.CalledProcessError(
-                        restore_process.returncode, restore_process.args
-                    )
-
-            except subprocess.CalledProcessError as e:
-                print(f"Checkpoint restore failed: {e}")
-                # Clean up the checkpoint if restore fails
-                clear_checkpoints(context)
-                raise RuntimeError("Checkpoint restore failed")
-            else:
-                yield
-                return  # Exit the context manager early if restore succeeds
+        except PermissionError:
+            raise RuntimeError("Cannot create lock file - permission denied")
+        try:
+            _set_lock(lock_fd, fcntl.F_WRLCK)
+        except OSError:  # EAGAIN or EACCES when held elsewhere
+            os.close(lock_fd)
+            lock_fd = None
+            raise RuntimeError("Another crio process is running")
 
-        # If no existing checkpoint, create a new checkpoint
+        # Fork a child to run the block, then checkpoint it from the parent
         pid = os.fork()
         if pid == 0:  # Child process
             am_child = True
@@ -191,7 +572,11 @@ def checkpoint(context: dict | None = None):
                     lock_fd = None
 
                 # Yield control back to user code (imports etc. in context manager body)
-                yield
+                _in_checkpoint_block = True
+                try:
+                    yield
+                finally:
+                    _in_checkpoint_block = False
 
                 # Stop ourselves so the parent can dump (checkpoint)
                 os.kill(os.getpid(), signal.SIGSTOP)
@@ -205,55 +590,40 @@ def checkpoint(context: dict | None = None):
         else:  # Parent process
             child_pid = pid
             try:
-                # Wait for child to stop with timeout
-                start_time = time.time()
-                while True:
-                    try:
-                        _, status = os.waitpid(pid, os.WUNTRACED)
-                        if os.WIFSTOPPED(status):
-                            break
-                    except ProcessLookupError:
-                        print("Child process exited unexpectedly")
-                        raise RuntimeError("Child process exited unexpectedly")
-
-                    if time.time() - start_time > 5:  # 5 second timeout
-                        print("Child process failed to stop within timeout")
-                        raise RuntimeError(
-                            "Child process failed to stop within timeout"
-                        )
-
-                    time.sleep(0.1)  # Prevent busy waiting
-
-                # Create checkpoint with --leave-running
+                # Sleep in the kernel until the child stops (or exits), no polling. No
+                # SIGCHLD wait: another thread could take (and drop) the signal. And a
+                # pidfd would only become readable on exit, not on SIGSTOP.
+                info = os.waitid(os.P_PID, pid, os.WSTOPPED | os.WEXITED)
+                if info.si_code != os.CLD_STOPPED:
+                    print("Child process exited unexpectedly")
+                    raise RuntimeError("Child process exited unexpectedly")
+
+                # Create checkpoint with --leave-running. No `criu pre-dump` first: that
+                # only shortens the freeze of a process that is still running, but the
+                # child has already stopped itself at the point to checkpoint (and any
+                # pages pre-dumped while it ran the block would be dirtied again).
                 print(f"Creating checkpoint for PID {pid}")
-                subprocess.run(
+                _spawn_criu(
                     [
-                        "sudo",
-                        "criu",
                         "dump",
                         "-t",
                         str(pid),
                         "-D",
                         str(tmp_checkpoint_dir),
                         "--unprivileged",
-                        "--shell-job",
                         "--leave-running",  # Keep the process running
-                        "--skip-in-flight",
-                        "--ext-unix-sk",
-                        "--file-locks",
-                        "--link-remap",
-                        "--manage-cgroups",
+                        *criu_flags,
                     ],
-                    check=True,
-                    capture_output=True,
-                    text=True,
+                    cpu=_last_cpu(pid),
                 )
 
-                # Continue the child process after checkpoint
+                # Continue the child process after checkpoint. Not any sooner (while
+                # criu dumps asynchronously): the child would run on past the point
+                # being checkpointed while criu still reads its memory.
                 os.kill(pid, signal.SIGCONT)
 
-                # Mark checkpoint as existing
-                (tmp_checkpoint_dir / "checkpoint.exists").touch()
+                # Mark checkpoint as existing (its fsync is off the child's path)
+                _mark_checkpoint_complete(tmp_checkpoint_dir)
                 print("Checkpoint created successfully")
 
             except Exception as e:
@@ -278,55 +648,103 @@ def checkpoint(context: dict | None = None):
         if not am_child:
             # "Parent" normally never gets here because of `os.exit(0)` above;
             # but if we removed the `_exit`, we'd do:
-            # Clean up lock file and descriptor
+            # Release the lock. The lock file itself is left in place: unlinking it
+            # would let another process lock a fresh file at the same path while a
+            # third still holds the lock on the old one.
             if lock_fd is not None:
                 try:
-                    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                    _set_lock(lock_fd, fcntl.F_UNLCK)
                     os.close(lock_fd)
-                    lock_file.unlink()
-                except (OSError, FileNotFoundError):
+                except OSError:
                     pass
-        else:
-            # We are the child. The child's FD is already closed, so skip the
-            # flock(...) / close(...) calls. But we *can* remove the lock file on disk
-            # so it doesn't linger:
-            if lock_file.exists():
-                lock_file.unlink()
+        # The child's FD is already closed, and the lock file is persistent, so the
+        # child has nothing to clean up here.
 
     # The child returns normally, so everything after the context manager block can run
     return
 
 
-def clear_checkpoints(context: dict | None = None) -> None:
+def restore_from_template(
+    context: dict | None = None,
+    n: int = 1,
+    criu_flags: Sequence[str] = DEFAULT_FLAGS,
+    strict: bool = True,
+) -> list[int]:
+    """
+    Restore `n` copies of an existing checkpoint (dumped by a `checkpoint()` block with
+    the same `context`, `criu_flags` and `strict`) alongside this process, each running
+    on from the end of the block. Returns the PIDs to `os.waitpid` on.
+
+    A restored process gets back its original PID, so each copy is restored into a new
+    PID namespace (by `unshare --pid --fork --mount-proc`, with its own `/proc` so that
+    criu finds the restored tasks by their PIDs in it), where criu runs as init and
+    stays until that copy exits. Creating the namespaces needs root: a file capability
+    on criu does not extend to `unshare`, so unless running as root this always goes via
+    `sudo -n` (passwordless sudo is needed for `unshare`). The restores only read the
+    images, so all of them share the one dump.
+    """
+    ckpt_id = _generate_checkpoint_id(context, strict=strict)
+    _, tmp_checkpoint_dir = _get_checkpoint_dirs(ckpt_id)
+    if not (tmp_checkpoint_dir / "checkpoint.exists").exists():
+        raise RuntimeError("No checkpoint to restore from")
+    argv = [
+        *_unshare_cmd(),
+        _criu_cmd()[-1],
+        "restore",
+        "-D",
+        str(tmp_checkpoint_dir),
+        "--unprivileged",
+        *criu_flags,
+    ]
+    return [os.posix_spawn(argv[0], argv, os.environ) for _ in range(n)]
+
+
+def clear_checkpoints(context: dict | None = None, strict: bool = True) -> None:
     """Clear all checkpoints or those matching a specific context"""
     base_dir = _get_checkpoint_path()
     if context is not None:
         # Remove specific checkpoint
-        base_checkpoint_dir = base_dir / _generate_checkpoint_id(context)
-        tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
-        # Remove symlink and base checkpoint dir
-        if base_checkpoint_dir.exists():
-            import shutil
-
-            # Remove symlink first
-            symlink_path = base_checkpoint_dir / "ckpt"
-            if symlink_path.is_symlink():
-                symlink_path.unlink()
-            # Remove base checkpoint directory
-            shutil.rmtree(base_checkpoint_dir)
-            # Remove tmp checkpoint directory
-            if tmp_checkpoint_dir.exists():
-                import shutil
-
-                shutil.rmtree(tmp_checkpoint_dir)
+        ckpt_id = _generate_checkpoint_id(context, strict=strict)
+        base_checkpoint_dir, tmp_checkpoint_dir = _get_checkpoint_dirs(ckpt_id)
+        # Move both dirs aside (the ckpt symlink goes with the base dir, and rmtree
+        # doesn't follow it), then delete them together in the background
+        trash_dirs = [
+            _move_to_trash(checkpoint_dir)
+            for checkpoint_dir in (base_checkpoint_dir, tmp_checkpoint_dir)
+            if checkpoint_dir.exists()
+        ]
+        _remove_in_background(trash_dirs)
     else:
-        # Remove all checkpoints
-        import glob
-        import shutil
-
-        # Remove user cache dir checkpoints
-        shutil.rmtree(base_dir)
-        base_dir.mkdir(parents=True)
-        # Remove all /tmp criu checkpoint directories
-        for tmp_dir in glob.glob("/tmp/criu-*"):
-            shutil.rmtree(tmp_dir)
+        # Remove all checkpoints: each dir is moved aside with a single rename, then
+        # deleted in the background since the image dirs can be large. That is only
+        # finished at exit or the next `checkpoint()`, so a deletion cut short (e.g. by
+        # a kill) leaves trash dirs behind, which are picked up here too (collected
+        # before this clear adds its own, so none is collected twice).
+        base_trash_prefix = f".{base_dir.name}.trash-"
+        _ensure_base_dir()  # Both to scan its parent and to move it aside below
+        with os.scandir(base_dir.parent) as entries:
+            trash_dirs = [
+                Path(entry.path)
+                for entry in entries
+                if entry.name.startswith(base_trash_prefix)
+                and entry.is_dir(follow_symlinks=False)
+            ]
+        # Scan /tmp once for criu checkpoint dirs and trash (scandir: no stat per
+        # entry), only renaming once the scan is done so it can't see the new names
+        with os.scandir(TMP_DIR) as entries:
+            tmp_dirs = [
+                (entry.name, Path(entry.path))
+                for entry in entries
+                if entry.name.startswith(("criu-", ".criu-"))
+                and entry.is_dir(follow_symlinks=False)
+            ]
+        for name, path in tmp_dirs:
+            if name.startswith("criu-"):
+                trash_dirs.append(_move_to_trash(path))
+            elif ".trash-" in name:
+                trash_dirs.append(path)
+        # Remove user cache dir checkpoints, leaving an empty dir in its place
+        trash_dirs.append(_move_to_trash(base_dir))
+        _ensure_base_dir()
+        _remove_in_background(trash_dirs)
+
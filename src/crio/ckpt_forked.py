@@ -5,7 +5,6 @@ import os
 import signal
 import subprocess
 import sys
-import time
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -32,23 +31,22 @@ def _generate_checkpoint_id(context: dict | None = None) -> str:
         "python_version": sys.version,
         # Only include environment vars that affect Python imports
         "env": {
-            k: v
-            for k, v in os.environ.items()
-            if k.startswith(("PYTHONPATH", "PYTHONHOME"))
+            k: os.environ[k] for k in ("PYTHONHOME", "PYTHONPATH") if k in os.environ
         },
     }
     if context is not None:
         checkpoint_context.update(context)
     context_str = json.dumps(checkpoint_context, sort_keys=True)
-    return hashlib.sha256(context_str.encode()).hexdigest()[:16]
+    return hashlib.blake2b(context_str.encode(), digest_size=8).hexdigest()
 
 
 @contextmanager
 def checkpoint(context: dict | None = None):
+    ckpt_id = _generate_checkpoint_id(context)
     # Base user-level checkpoint directory
-    base_checkpoint_dir = _get_checkpoint_path() / _generate_checkpoint_id(context)
+    base_checkpoint_dir = _get_checkpoint_path() / ckpt_id
     # Temporary checkpoint directory in /tmp
-    tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+    tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
     lock_file = base_checkpoint_dir / "crio.lock"
     lock_fd = None
     child_pid = None
@@ -59,27 +57,32 @@ def checkpoint(context: dict | None = None):
             (base_checkpoint_dir, "checkpoint directory"),
             (tmp_checkpoint_dir, "temporary checkpoint directory"),
         ]:
+            # Private (the images hold process memory), parents exist already
             try:
-                dir_path.mkdir(parents=True, exist_ok=True)
+                os.mkdir(dir_path, 0o700)
+            except FileExistsError:
+                pass
             except PermissionError:
                 raise RuntimeError(f"Cannot create {err_msg} - permission denied")
 
         # Create symlink from base to tmp if it doesn't exist
         symlink_path = base_checkpoint_dir / "ckpt"
-        if not symlink_path.exists():
-            symlink_path.symlink_to(tmp_checkpoint_dir)
+        try:
+            os.symlink(tmp_checkpoint_dir, symlink_path)
+        except FileExistsError:
+            pass
 
-        # Acquire lock file
+        # Acquire lock file (a POSIX record lock, released when the holder closes it)
         try:
-            lock_fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
-            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except (PermissionError, IOError) as e:
-            if lock_fd is not None:
-                os.close(lock_fd)
-            if isinstance(e, PermissionError):
-                raise RuntimeError("Cannot create lock file - permission denied")
-            else:
-                raise RuntimeError("Another crio process is running")
+            lock_fd = os.open(lock_file, os.O_CREAT | os.O_RDWR, 0o644)
+        except PermissionError:
+            raise RuntimeError("Cannot create lock file - permission denied")
+        try:
+            fcntl.lockf(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:  # EAGAIN or EACCES when held elsewhere
+            os.close(lock_fd)
+            lock_fd = None
+            raise RuntimeError("Another crio process is running")
 
         # Check for existing checkpoint
         if (tmp_checkpoint_dir / "checkpoint.exists").exists():
@@ -144,23 +147,14 @@ def checkpoint(context: dict | None = None):
         else:  # Parent process
             child_pid = pid
             try:
-                # Wait for child to stop with timeout
-                start_time = time.time()
-                while True:
-                    try:
-                        _, status = os.waitpid(pid, os.WUNTRACED)
-                        if os.WIFSTOPPED(status):
-                            break
-                    except ProcessLookupError:
-                        print("Child process exited unexpectedly")
-                        raise RuntimeError("Child process exited unexpectedly")
-                    
-                    if time.time() - start_time > 5:  # 5 second timeout
-                        print("Child process failed to stop within timeout")
-                        raise RuntimeError("Child process failed to stop within timeout")
-                    
-                    time.sleep(0.1)  # Prevent busy waiting
-                
+                # Sleep in the kernel until the child stops (or exits), no polling. No
+                # SIGCHLD wait: another thread could take (and drop) the signal. And a
+                # pidfd would only become readable on exit, not on SIGSTOP.
+                _, status = os.waitpid(pid, os.WUNTRACED)
+                if not os.WIFSTOPPED(status):
+                    print("Child process exited unexpectedly")
+                    raise RuntimeError("Child process exited unexpectedly")
+
                 # Create checkpoint with --leave-running
                 print(f"Creating checkpoint for PID {pid}")
                 subprocess.run(
@@ -209,14 +203,10 @@ def checkpoint(context: dict | None = None):
         print(f"Checkpoint error: {e}")
         raise
     finally:
-        # Clean up lock file and descriptor
+        # Closing the descriptor releases the lock. The lock file stays: unlinking it
+        # would let another process lock a fresh file at the same path meanwhile.
         if lock_fd is not None:
-            try:
-                fcntl.flock(lock_fd, fcntl.LOCK_UN)
-                os.close(lock_fd)
-                lock_file.unlink()
-            except FileNotFoundError:
-                pass
+            os.close(lock_fd)
 
 
 def clear_checkpoints(context: dict | None = None) -> None:
@@ -224,8 +214,9 @@ def clear_checkpoints(context: dict | None = None) -> None:
     base_dir = _get_checkpoint_path()
     if context is not None:
         # Remove specific checkpoint
-        base_checkpoint_dir = base_dir / _generate_checkpoint_id(context)
-        tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+        ckpt_id = _generate_checkpoint_id(context)
+        base_checkpoint_dir = base_dir / ckpt_id
+        tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
         # Remove symlink and base checkpoint dir
         if base_checkpoint_dir.exists():
             import shutil
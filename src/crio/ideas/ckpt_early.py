@@ -4,7 +4,6 @@ import json
 import os
 import signal
 import subprocess
-import time
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -46,11 +45,12 @@ def _generate_checkpoint_id(context: dict | None = None) -> str:
 
 @contextmanager
 def checkpoint(context: dict | None = None):
+    ckpt_id = _generate_checkpoint_id(context)
     # Base user-level checkpoint directory
-    base_checkpoint_dir = _get_checkpoint_path() / _generate_checkpoint_id(context)
+    base_checkpoint_dir = _get_checkpoint_path() / ckpt_id
     
     # Temporary checkpoint directory in /tmp
-    tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+    tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
     
     lock_file = base_checkpoint_dir / "crio.lock"
     lock_fd = None
@@ -119,21 +119,10 @@ def checkpoint(context: dict | None = None):
                     os._exit(1)
             else:  # Parent process
                 try:
-                    # Wait for child to stop with timeout
-                    start_time = time.time()
-                    while True:
-                        try:
-                            _, status = os.waitpid(pid, os.WUNTRACED)
-                            if os.WIFSTOPPED(status):
-                                break
-                        except ProcessLookupError:
-                            raise RuntimeError("Child process exited unexpectedly")
-
-                        if time.time() - start_time > 5:  # 5 second timeout
-                            raise RuntimeError(
-                                "Child process failed to stop within timeout"
-                            )
-                        time.sleep(0.1)  # Prevent busy waiting
+                    # Sleep in the kernel until the child stops (or exits), no polling
+                    info = os.waitid(os.P_PID, pid, os.WSTOPPED | os.WEXITED)
+                    if info.si_code != os.CLD_STOPPED:
+                        raise RuntimeError("Child process exited unexpectedly")
 
                     # Create checkpoint
                     try:
@@ -180,9 +169,10 @@ def clear_checkpoints(context: dict | None = None) -> None:
     """Clear all checkpoints or those matching a specific context"""
     base_dir = _get_checkpoint_path()
     if context is not None:
+        ckpt_id = _generate_checkpoint_id(context)
         # Remove specific checkpoint
-        base_checkpoint_dir = base_dir / _generate_checkpoint_id(context)
-        tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+        base_checkpoint_dir = base_dir / ckpt_id
+        tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
         
         # Remove symlink and base checkpoint dir
         if base_checkpoint_dir.exists():
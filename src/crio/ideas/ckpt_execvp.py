@@ -1,10 +1,12 @@
 import fcntl
+import glob
 import hashlib
 import json
 import os
+import select
+import shutil
 import signal
 import subprocess
-import time
 from contextlib import contextmanager
 from pathlib import Path
 from platformdirs import user_cache_dir
@@ -39,8 +41,9 @@ def _generate_checkpoint_id(context: dict | None = None) -> str:
 
 @contextmanager
 def checkpoint(context: dict | None = None):
-    base_checkpoint_dir = _get_checkpoint_path() / _generate_checkpoint_id(context)
-    tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+    ckpt_id = _generate_checkpoint_id(context)
+    base_checkpoint_dir = _get_checkpoint_path() / ckpt_id
+    tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
     lock_file = base_checkpoint_dir / "crio.lock"
     lock_fd = None
     child_pid = None
@@ -90,36 +93,50 @@ def checkpoint(context: dict | None = None):
                     os._exit(0)
             else:  # Parent
                 child_pid = pid
-                # Wait for child to stop
-                while True:
-                    _, status = os.waitpid(pid, os.WUNTRACED)
-                    if os.WIFSTOPPED(status):
-                        break
-                # Create checkpoint
-                subprocess.run(
-                    [
-                        "sudo",
-                        "criu",
-                        "dump",
-                        "-t",
-                        str(pid),
-                        "-D",
-                        str(tmp_checkpoint_dir),
-                        "--unprivileged",
-                        "--shell-job",
-                        "--leave-running",
-                        "--skip-in-flight",
-                        "--ext-unix-sk",
-                        "--file-locks",
-                        "--link-remap",
-                        "--manage-cgroups",
-                    ],
-                    check=True,
-                )
-                (tmp_checkpoint_dir / "checkpoint.exists").touch()
-                # Resume child and wait for exit
-                os.kill(pid, signal.SIGCONT)
-                os.waitpid(pid, 0)
+                # Refers to this child only, even if the PID is later reused. Opening it
+                # after fork() is race-free: until we wait on it, even an exited child
+                # is a zombie holding its PID, so the PID can't be reused in between.
+                pidfd = os.pidfd_open(pid)
+                try:
+                    # Wait for child to stop (blocking, no SIGCHLD another thread
+                    # could take and drop)
+                    info = os.waitid(os.P_PID, pid, os.WSTOPPED | os.WEXITED)
+                    if info.si_code != os.CLD_STOPPED:
+                        raise RuntimeError("Child process exited unexpectedly")
+                    # Create checkpoint
+                    try:
+                        subprocess.run(
+                            [
+                                "sudo",
+                                "criu",
+                                "dump",
+                                "-t",
+                                str(pid),
+                                "-D",
+                                str(tmp_checkpoint_dir),
+                                "--unprivileged",
+                                "--shell-job",
+                                "--leave-running",
+                                "--skip-in-flight",
+                                "--ext-unix-sk",
+                                "--file-locks",
+                                "--link-remap",
+                                "--manage-cgroups",
+                            ],
+                            check=True,
+                        )
+                    except BaseException:
+                        # Don't leave the stopped child behind if the dump fails
+                        signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+                        os.waitid(os.P_PIDFD, pidfd, os.WEXITED)
+                        raise
+                    (tmp_checkpoint_dir / "checkpoint.exists").touch()
+                    # Resume child and wait for exit (pidfd is readable once it exits)
+                    signal.pidfd_send_signal(pidfd, signal.SIGCONT)
+                    select.select([pidfd], [], [])
+                    os.waitid(os.P_PIDFD, pidfd, os.WEXITED)
+                finally:
+                    os.close(pidfd)
     finally:
         # Cleanup logic remains
         if lock_fd is not None:
@@ -132,11 +149,11 @@ def clear_checkpoints(context: dict | None = None) -> None:
     base_dir = _get_checkpoint_path()
     if context is not None:
         # Remove specific checkpoint
-        base_checkpoint_dir = base_dir / _generate_checkpoint_id(context)
-        tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+        ckpt_id = _generate_checkpoint_id(context)
+        base_checkpoint_dir = base_dir / ckpt_id
+        tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
         # Remove symlink and base checkpoint dir
         if base_checkpoint_dir.exists():
-            import shutil
             # Remove symlink first
             symlink_path = base_checkpoint_dir / "ckpt"
             if symlink_path.is_symlink():
@@ -145,12 +162,9 @@ def clear_checkpoints(context: dict | None = None) -> None:
             shutil.rmtree(base_checkpoint_dir)
             # Remove tmp checkpoint directory
             if tmp_checkpoint_dir.exists():
-                import shutil
                 shutil.rmtree(tmp_checkpoint_dir)
     else:
         # Remove all checkpoints
-        import glob
-        import shutil
         # Remove user cache dir checkpoints
         shutil.rmtree(base_dir)
         base_dir.mkdir(parents=True)
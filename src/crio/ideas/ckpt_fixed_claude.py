@@ -45,8 +45,9 @@ def _generate_checkpoint_id(context: dict | None = None) -> str:
 
 @contextmanager
 def checkpoint(context: dict | None = None):
-    base_checkpoint_dir = _get_checkpoint_path() / _generate_checkpoint_id(context)
-    tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+    ckpt_id = _generate_checkpoint_id(context)
+    base_checkpoint_dir = _get_checkpoint_path() / ckpt_id
+    tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
     lock_file = base_checkpoint_dir / "crio.lock"
     lock_fd = None
     child_pid = None
@@ -201,9 +202,10 @@ def clear_checkpoints(context: dict | None = None) -> None:
     """Clear all checkpoints or those matching a specific context"""
     base_dir = _get_checkpoint_path()
     if context is not None:
+        ckpt_id = _generate_checkpoint_id(context)
         # Remove specific checkpoint
-        base_checkpoint_dir = base_dir / _generate_checkpoint_id(context)
-        tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+        base_checkpoint_dir = base_dir / ckpt_id
+        tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
         # Remove symlink and base checkpoint dir
         if base_checkpoint_dir.exists():
             import shutil
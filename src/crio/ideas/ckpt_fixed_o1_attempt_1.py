@@ -62,10 +62,11 @@ def checkpoint(context: dict | None = None):
        `print(...)`.
     5. Parent: calls `os._exit(0)` so it goes away quietly.
     """
+    ckpt_id = _generate_checkpoint_id(context)
     # Base user-level checkpoint directory
-    base_checkpoint_dir = _get_checkpoint_path() / _generate_checkpoint_id(context)
+    base_checkpoint_dir = _get_checkpoint_path() / ckpt_id
     # Temporary checkpoint directory in /tmp
-    tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+    tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
     lock_file = base_checkpoint_dir / "crio.lock"
     lock_fd = None
     child_pid = None
@@ -249,9 +250,10 @@ def clear_checkpoints(context: dict | None = None) -> None:
     """Clear all checkpoints or those matching a specific context"""
     base_dir = _get_checkpoint_path()
     if context is not None:
+        ckpt_id = _generate_checkpoint_id(context)
         # Remove specific checkpoint
-        base_checkpoint_dir = base_dir / _generate_checkpoint_id(context)
-        tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+        base_checkpoint_dir = base_dir / ckpt_id
+        tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
         # Remove symlink and base checkpoint dir
         if base_checkpoint_dir.exists():
             import shutil
@@ -3,7 +3,6 @@ import hashlib
 import json
 import os
 import signal
-import subprocess
 import sys
 import time
 from contextlib import contextmanager
@@ -41,8 +40,9 @@ def _generate_checkpoint_id(context: dict | None = None) -> str:
 
 @contextmanager
 def checkpoint(context: dict | None = None):
-    base_checkpoint_dir = _get_checkpoint_path() / _generate_checkpoint_id(context)
-    tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+    ckpt_id = _generate_checkpoint_id(context)
+    base_checkpoint_dir = _get_checkpoint_path() / ckpt_id
+    tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
     lock_file = base_checkpoint_dir / "crio.lock"
     lock_fd = None
     helper_pid = None
@@ -102,7 +102,9 @@ def checkpoint(context: dict | None = None):
                 try:
                     _, status = os.waitpid(main_pid, os.WUNTRACED)
                     if os.WIFSTOPPED(status):
-                        subprocess.run(
+                        # Spawn criu directly from the helper (no second fork())
+                        criu_pid = os.posix_spawnp(
+                            "sudo",
                             [
                                 "sudo",
                                 "criu",
@@ -120,8 +122,11 @@ def checkpoint(context: dict | None = None):
                                 "--link-remap",
                                 "--manage-cgroups",
                             ],
-                            check=True,
+                            os.environ,
                         )
+                        _, criu_status = os.waitpid(criu_pid, 0)
+                        if os.waitstatus_to_exitcode(criu_status) != 0:
+                            raise RuntimeError("Checkpoint creation failed")
                         (tmp_checkpoint_dir / "checkpoint.exists").touch()
                         os.kill(main_pid, signal.SIGCONT)
                 finally:
@@ -149,8 +154,9 @@ def checkpoint(context: dict | None = None):
 def clear_checkpoints(context: dict | None = None) -> None:
     base_dir = _get_checkpoint_path()
     if context is not None:
-        base_checkpoint_dir = base_dir / _generate_checkpoint_id(context)
-        tmp_checkpoint_dir = Path(f"/tmp/criu-{_generate_checkpoint_id(context)}")
+        ckpt_id = _generate_checkpoint_id(context)
+        base_checkpoint_dir = base_dir / ckpt_id
+        tmp_checkpoint_dir = Path(f"/tmp/criu-{ckpt_id}")
         if base_checkpoint_dir.exists():
             import shutil
 
@@ -0,0 +1,54 @@
+import logging
+
+import pytest
+
+from crio import ckpt_fixed_o1
+
+
+@pytest.fixture
+def checkpoint_root(tmp_path, monkeypatch):
+    """Point the cache dir and /tmp at a temp dir"""
+    cache_dir = tmp_path / "cache" / "crio"
+    tmp_dir = tmp_path / "tmp"
+    tmp_dir.mkdir()
+    monkeypatch.setattr(ckpt_fixed_o1, "_get_checkpoint_path", lambda: cache_dir)
+    monkeypatch.setattr(ckpt_fixed_o1, "TMP_DIR", tmp_dir)
+    ckpt_fixed_o1._get_checkpoint_dirs.cache_clear()
+    yield cache_dir, tmp_dir
+    ckpt_fixed_o1._get_checkpoint_dirs.cache_clear()
+
+
+def test_clear_all_checkpoints(checkpoint_root, caplog):
+    cache_dir, tmp_dir = checkpoint_root
+    (cache_dir / "0123456789abcdef").mkdir(parents=True)
+    (cache_dir / "0123456789abcdef" / "crio.lock").touch()
+    # Trash left behind by an earlier clear that was cut short
+    (cache_dir.parent / ".crio.trash-00000000" / "old").mkdir(parents=True)
+    for name in ("criu-0123456789abcdef", "criu-fedcba9876543210"):
+        (tmp_dir / name).mkdir()
+        (tmp_dir / name / "pages-1.img").write_bytes(b"\0" * 4096)
+    (tmp_dir / ".criu-0000000000000000.trash-00000000" / "old").mkdir(parents=True)
+    (tmp_dir / "unrelated").mkdir()
+    with caplog.at_level(logging.WARNING):
+        ckpt_fixed_o1.clear_checkpoints()
+        ckpt_fixed_o1._wait_for_removals()
+    assert caplog.records == []
+    assert sorted(p.name for p in tmp_dir.iterdir()) == ["unrelated"]
+    assert sorted(p.name for p in cache_dir.parent.iterdir()) == ["crio"]
+    assert list(cache_dir.iterdir()) == []
+
+
+def test_clear_context_checkpoint(checkpoint_root, caplog):
+    cache_dir, tmp_dir = checkpoint_root
+    context = {"torch": "2.5.1"}
+    ckpt_id = ckpt_fixed_o1._generate_checkpoint_id(context)
+    other_id = ckpt_fixed_o1._generate_checkpoint_id({"torch": "2.4.0"})
+    for ckpt in (ckpt_id, other_id):
+        (cache_dir / ckpt).mkdir(parents=True)
+        (tmp_dir / f"criu-{ckpt}").mkdir()
+    with caplog.at_level(logging.WARNING):
+        ckpt_fixed_o1.clear_checkpoints(context)
+        ckpt_fixed_o1._wait_for_removals()
+    assert caplog.records == []
+    assert [p.name for p in cache_dir.iterdir()] == [other_id]
+    assert [p.name for p in tmp_dir.iterdir()] == [f"criu-{other_id}"]
@@ -0,0 +1,74 @@
+import os
+import stat
+import subprocess
+
+import pytest
+
+from crio import ckpt_fixed_o1
+
+
+@pytest.fixture
+def checkpoint_dirs(tmp_path, monkeypatch):
+    """Point the checkpoint dirs at a temp dir, and record spawns instead of running"""
+    dirs = tmp_path / "base", tmp_path / "criu-test"
+    for checkpoint_dir in dirs:
+        checkpoint_dir.mkdir()
+    monkeypatch.setattr(ckpt_fixed_o1, "_get_checkpoint_dirs", lambda ckpt_id: dirs)
+    # criu with file capabilities: called directly, without sudo
+    monkeypatch.setattr(ckpt_fixed_o1, "_criu_cmd", lambda: ("/usr/sbin/criu",))
+    monkeypatch.setattr(os, "geteuid", lambda: 1000)
+    ckpt_fixed_o1._unshare_cmd.cache_clear()
+    spawned = []
+
+    def posix_spawn(path, argv, env):
+        spawned.append(argv)
+        return 10000 + len(spawned)
+
+    monkeypatch.setattr(os, "posix_spawn", posix_spawn)
+    yield dirs, spawned
+    ckpt_fixed_o1._unshare_cmd.cache_clear()
+
+
+def test_restore_without_checkpoint(checkpoint_dirs):
+    _, spawned = checkpoint_dirs
+    with pytest.raises(RuntimeError, match="No checkpoint"):
+        ckpt_fixed_o1.restore_from_template({"v": 1})
+    assert spawned == []
+
+
+def test_restore_from_template(checkpoint_dirs):
+    (_, tmp_checkpoint_dir), spawned = checkpoint_dirs
+    ckpt_fixed_o1._mark_checkpoint_complete(tmp_checkpoint_dir)
+    mode = stat.S_IMODE(tmp_checkpoint_dir.stat().st_mode)
+    pids = ckpt_fixed_o1.restore_from_template({"v": 1}, n=3)
+    assert pids == [10001, 10002, 10003]
+    assert len(spawned) == 3
+    argv = spawned[0]
+    # Not root: unshare goes via sudo even though criu has capabilities
+    assert argv[argv.index("-n") - 1].endswith("sudo")
+    unshare_at = next(i for i, arg in enumerate(argv) if arg.endswith("unshare"))
+    assert argv[unshare_at + 1 : unshare_at + 7] == [
+        "--pid",
+        "--fork",
+        "--mount-proc",
+        "--",
+        "/usr/sbin/criu",
+        "restore",
+    ]
+    assert str(tmp_checkpoint_dir) in argv
+    # The shared images dir is left as it was (e.g. for a later lazy-pages socket)
+    assert stat.S_IMODE(tmp_checkpoint_dir.stat().st_mode) == mode
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="Creating a PID namespace needs root")
+def test_unshare_cmd_isolates_pids():
+    """What criu sees when run by the prefix: it is init, and /proc is the new PID ns"""
+    ckpt_fixed_o1._unshare_cmd.cache_clear()
+    script = 'echo $$; ls /proc | grep -c "^[0-9]"'
+    argv = [*ckpt_fixed_o1._unshare_cmd(), "/bin/sh", "-c", script]
+    result = subprocess.run(argv, capture_output=True, text=True)
+    if result.returncode != 0:
+        pytest.skip(f"Namespaces not permitted here: {result.stderr.strip()}")
+    own_pid, proc_pids = result.stdout.split()
+    assert own_pid == "1"
+    assert int(proc_pids) <= 3  # sh, and the ls and grep it runs